@@ -1,14 +1,23 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 import os
 import json
+import secrets
 from datetime import datetime
+from dataclasses import asdict
 from decimal import Decimal, ROUND_HALF_UP
 
 from data.products import (
     get_best_sellers, get_featured_products, get_products_by_category, get_product_by_id
 )
+from data.orders import save_order
 from utils.cart import CartManager
+from utils.jobs import job_queue, enqueue_order_jobs
+from utils.mpesa import parse_callback
+from utils.rate_limit import rate_limiter
+from utils.profiler import request_profiler
+from utils.inventory import inventory_manager, OutOfStockError
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # Change this in production
@@ -34,10 +43,21 @@ def currency_format(value):
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB max file size
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Number of reverse proxies (e.g. nginx) in front of gunicorn that set
+# X-Forwarded-For. Leave at 0 when clients connect directly, otherwise they
+# could spoof their address and dodge per-client rate limits.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app,
+                            x_for=app.config['TRUSTED_PROXIES'],
+                            x_proto=app.config['TRUSTED_PROXIES'])
 
 # Initialize cart manager
 cart_manager = CartManager()
 
+# Attach request profiler; configured by PROFILE_TOKEN and PROFILE_SAMPLE_RATE
+request_profiler.init_app(app)
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -151,6 +171,23 @@ def save_products(products):
     with open('products.json', 'w') as f:
         json.dump(products, f, indent=2)
 
+def parse_stock_quantity(raw):
+    """Parse the admin stock field; blank means the product is not tracked"""
+    raw = (raw or '').strip()
+    if not raw:
+        return None
+    quantity = int(raw)
+    if quantity < 0:
+        raise ValueError('Stock quantity cannot be negative')
+    return quantity
+
+def reserve_cart_stock():
+    """Reserve (or refresh) stock for the current cart and remember it in the session"""
+    items = [(item.id, item.quantity) for item in cart_manager.get_cart()]
+    reservation_id = inventory_manager.reserve(items, session.get('reservation_id'))
+    session['reservation_id'] = reservation_id
+    return reservation_id
+
 @app.route('/')
 def home():
     return render_template('home.html', 
@@ -195,6 +232,7 @@ def cart():
     return render_template('cart.html', cart_items=cart_items, subtotal=subtotal)
 
 @app.route('/get_cart_count')
+@rate_limiter.limit('cart')
 def get_cart_count():
     return jsonify({
         'count': cart_manager.get_total_count(),
@@ -202,10 +240,13 @@ def get_cart_count():
     })
 
 @app.route('/add_to_cart', methods=['POST'])
+@rate_limiter.limit('cart')
 def add_to_cart():
     product_id = request.json.get('product_id')
     product = get_product_by_id(product_id)
     if product:
+        if not product.in_stock:
+            return jsonify({'success': False, 'error': 'Out of stock'}), 409
         cart_manager.add_item(product)
         return jsonify({
             'success': True,
@@ -225,9 +266,15 @@ def remove_from_cart():
     })
 
 @app.route('/update_quantity', methods=['POST'])
+@rate_limiter.limit('cart')
 def update_quantity():
     product_id = request.json.get('product_id')
-    quantity = request.json.get('quantity', 1)
+    try:
+        quantity = int(request.json.get('quantity', 1))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Invalid quantity'}), 400
+    # Checkout cannot hold more than this many units per product anyway
+    quantity = min(quantity, inventory_manager.MAX_UNITS_PER_LINE)
     cart_manager.update_quantity(product_id, quantity)
     return jsonify({
         'success': True,
@@ -247,7 +294,7 @@ def clear_cart():
 
 @app.route('/place_order', methods=['POST'])
 def place_order():
-    """Accept order data, normalize phones, save a simple order record, and clear the cart."""
+    """Accept order data, normalize phones, reserve stock, save the order and queue follow-up jobs."""
     try:
         data = request.get_json() or {}
         full_name = (data.get('full_name') or '').strip()
@@ -272,50 +319,90 @@ def place_order():
 
         # Build order object
         order = {
-            'id': datetime.now().strftime('%Y%m%d%H%M%S'),
+            'id': datetime.now().strftime('%Y%m%d%H%M%S') + secrets.token_hex(2),
             'full_name': full_name,
             'email': email,
             'phone': phone,
             'mpesa_phone': mpesa_phone,
             'address': address,
             'notes': notes,
-            'items': cart_manager.get_cart(),
+            'items': [asdict(item) for item in cart_manager.get_cart()],
             'total': cart_manager.get_total_price(),
+            'payment_status': 'awaiting_prompt' if mpesa_phone else 'unpaid',
             'created_at': datetime.now().isoformat()
         }
 
-        # Save to orders.json (append)
-        orders_file = 'orders.json'
+        # Hold stock for the cart; refreshes the hold taken when checkout was opened
         try:
-            if os.path.exists(orders_file):
-                with open(orders_file, 'r', encoding='utf-8') as f:
-                    existing = json.load(f) or []
-            else:
-                existing = []
-        except Exception:
-            existing = []
+            reservation_id = reserve_cart_stock()
+        except OutOfStockError as e:
+            product = get_product_by_id(e.product_id)
+            name = product.name if product else e.product_id
+            return jsonify({
+                'success': False,
+                'error': f'Only {e.available} of {name} available'
+            }), 409
+
+        # Turn the hold into a permanent decrement before the order exists, so a
+        # failure here leaves nothing behind and the shopper can simply retry
+        inventory_manager.commit(reservation_id)
+        session.pop('reservation_id', None)
 
-        existing.append(order)
+        # Save to orders.json (append)
         try:
-            with open(orders_file, 'w', encoding='utf-8') as f:
-                json.dump(existing, f, indent=2)
+            save_order(order)
         except Exception as e:
             print('Error saving order:', e)
+            try:
+                inventory_manager.restock((item['id'], item['quantity']) for item in order['items'])
+            except Exception as restock_error:
+                print('Error restocking unsaved order:', restock_error)
+            return jsonify({'success': False, 'error': 'Could not save order'}), 500
+
+        # The order is saved from here on, so never report failure to the shopper.
+        # Payment prompt and notifications run in worker.py, off the request thread;
+        # if queueing fails the worker's order sweep queues them later.
+        try:
+            enqueue_order_jobs(order)
+        except Exception as e:
+            print(f"Error queueing jobs for order {order['id']}:", e)
 
         # Clear the server-side cart
         cart_manager.clear_cart()
 
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'order_id': order['id']})
 
     except Exception as e:
         print('Error in place_order:', str(e))
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/mpesa/callback', methods=['POST'])
+def mpesa_callback():
+    """Acknowledge an M-Pesa STK callback and queue it for the worker"""
+    result = parse_callback(request.get_json(silent=True) or {})
+    if not result['checkout_request_id']:
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Missing CheckoutRequestID'}), 400
+
+    job_queue.enqueue('mpesa_callback', result,
+                      idempotency_key=f"mpesa_callback:{result['checkout_request_id']}")
+    return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
 @app.route('/checkout')
+@rate_limiter.limit('cart')
 def checkout():
     cart_items = cart_manager.get_cart()
     if not cart_items:
         return redirect(url_for('cart'))
+
+    # Hold stock while the shopper fills in the form; expires if abandoned
+    try:
+        reserve_cart_stock()
+    except OutOfStockError as e:
+        product = get_product_by_id(e.product_id)
+        name = product.name if product else e.product_id
+        flash(f'Only {e.available} of {name} available', 'error')
+        return redirect(url_for('cart'))
+
     subtotal = cart_manager.get_total_price()
     return render_template('checkout.html', cart_items=cart_items, subtotal=subtotal)
 
@@ -329,6 +416,8 @@ def contact():
 
 # Admin Routes
 @app.route('/api/search')
+@rate_limiter.limit('search')
+@rate_limiter.cap('search')
 def api_search():
     query = request.args.get('q', '').strip().lower()
     if not query or len(query) < 2:
@@ -429,6 +518,7 @@ def add_product():
             price = float(request.form.get('price'))
             description = request.form.get('description')
             in_stock = request.form.get('in_stock') == 'true'
+            stock_quantity = parse_stock_quantity(request.form.get('stock_quantity'))
             
             # Get sizes and colors (multiple values)
             sizes = [s.strip() for s in request.form.getlist('sizes') if s.strip()]
@@ -459,6 +549,7 @@ def add_product():
             # Save product
             products.append(product)
             save_products(products)
+            inventory_manager.set_stock(new_id, stock_quantity)
             
             flash('Product added successfully!', 'success')
             return redirect(url_for('admin_dashboard'))
@@ -476,6 +567,7 @@ def delete_product(product_id):
         products = load_products()
         products = [p for p in products if p['id'] != product_id]
         save_products(products)
+        inventory_manager.delete_product(product_id)
         
         return jsonify({'success': True})
     except Exception as e:
@@ -492,6 +584,8 @@ def edit_product(product_id):
     
     if request.method == 'POST':
         try:
+            stock_quantity = parse_stock_quantity(request.form.get('stock_quantity'))
+
             # Handle multiple image uploads
             uploaded_images = []
             image_files = request.files.getlist('images')
@@ -542,6 +636,7 @@ def edit_product(product_id):
             
             # Save updated products
             save_products(products)
+            inventory_manager.set_stock(product_id, stock_quantity)
             
             flash('Product updated successfully!', 'success')
             return redirect(url_for('admin_dashboard'))
@@ -550,7 +645,39 @@ def edit_product(product_id):
             flash(f'Error updating product: {str(e)}', 'error')
             return redirect(url_for('edit_product', product_id=product_id))
     
-    return render_template('admin/edit_product.html', product=product)
+    return render_template('admin/edit_product.html', product=product,
+                         stock_quantity=inventory_manager.get_stock(product_id))
+
+@app.route('/admin/profiles', methods=['GET', 'POST'])
+def admin_profiles():
+    """List captured request profiles and adjust the sampling rate"""
+    if not request_profiler.admin_authorized():
+        return "Forbidden", 403
+    if 'profile' in request.args:
+        # Keep the token out of the address bar and history once it is in the session
+        return redirect(url_for('admin_profiles'))
+
+    if request.method == 'POST':
+        try:
+            request_profiler.set_sample_rate(float(request.form.get('sample_rate', 0)))
+            flash('Sample rate updated', 'success')
+        except ValueError:
+            flash('Invalid sample rate', 'error')
+        return redirect(url_for('admin_profiles'))
+
+    return render_template('admin/profiles.html',
+                         profiles=request_profiler.list_profiles(),
+                         sample_rate=request_profiler.get_sample_rate())
+
+@app.route('/admin/profiles/<path:filename>')
+def admin_profile_file(filename):
+    """Download a profile's collapsed stacks, cProfile dump or summary"""
+    if not request_profiler.admin_authorized():
+        return "Forbidden", 403
+    if not filename.endswith(('.folded', '.prof', '.json')):
+        return "Profile not found", 404
+    return send_from_directory(os.path.abspath(app.config['PROFILE_DIR']), filename,
+                               as_attachment=filename.endswith('.prof'))
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,117 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import fcntl
+import json
+import os
+
+ORDERS_FILE = 'orders.json'
+LOCK_FILE = 'orders.json.lock'
+
+@contextmanager
+def _orders_lock():
+    """Serialize read-modify-write cycles on orders.json across workers"""
+    with open(LOCK_FILE, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _parse_orders() -> List[Dict[str, Any]]:
+    if not os.path.exists(ORDERS_FILE):
+        return []
+    with open(ORDERS_FILE, 'r', encoding='utf-8') as f:
+        content = f.read()
+    if not content.strip():
+        return []
+    return json.loads(content) or []
+
+def _read_orders() -> List[Dict[str, Any]]:
+    """Read orders for lookups; an unreadable file reads as empty"""
+    try:
+        return _parse_orders()
+    except (OSError, ValueError):
+        return []
+
+def _read_orders_for_update() -> List[Dict[str, Any]]:
+    """Read orders under the lock ahead of a write; raises rather than risk
+    overwriting history. A file that cannot be parsed is moved aside so it is
+    kept for recovery.
+    """
+    try:
+        return _parse_orders()
+    except json.JSONDecodeError:
+        corrupt_file = f"{ORDERS_FILE}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        os.replace(ORDERS_FILE, corrupt_file)
+        print(f'orders.json could not be parsed; moved it to {corrupt_file}')
+        raise
+
+def _write_orders(orders: List[Dict[str, Any]]) -> None:
+    # Write to a temp file first so readers never see a half-written file
+    tmp_file = f'{ORDERS_FILE}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(orders, f, indent=2)
+    os.replace(tmp_file, ORDERS_FILE)
+
+def load_orders() -> List[Dict[str, Any]]:
+    """Load all orders from JSON file"""
+    return _read_orders()
+
+def get_order(order_id: str) -> Optional[Dict[str, Any]]:
+    """Get order by ID"""
+    for order in _read_orders():
+        if order.get('id') == order_id:
+            return order
+    return None
+
+def save_order(order: Dict[str, Any]) -> None:
+    """Append an order to the JSON file"""
+    with _orders_lock():
+        orders = _read_orders_for_update()
+        orders.append(order)
+        _write_orders(orders)
+
+def update_order(order_id: str, **fields: Any) -> Optional[Dict[str, Any]]:
+    """Update fields on an order; returns the updated order or None if not found"""
+    with _orders_lock():
+        orders = _read_orders_for_update()
+        for order in orders:
+            if order.get('id') == order_id:
+                order.update(fields)
+                _write_orders(orders)
+                return order
+    return None
+
+def add_checkout_request(order_id: str, checkout_request_id: str) -> Optional[Dict[str, Any]]:
+    """Record an STK push's CheckoutRequestID on an order and mark it pending,
+    unless a callback has already settled it
+    """
+    with _orders_lock():
+        orders = _read_orders_for_update()
+        for order in orders:
+            if order.get('id') == order_id:
+                ids = order.setdefault('checkout_request_ids', [])
+                if checkout_request_id not in ids:
+                    ids.append(checkout_request_id)
+                if order.get('payment_status') == 'prompting':
+                    order['payment_status'] = 'pending'
+                _write_orders(orders)
+                return order
+    return None
+
+def find_order(**fields: Any) -> Optional[Dict[str, Any]]:
+    """Find the first order whose fields match all given values"""
+    for order in _read_orders():
+        if all(order.get(key) == value for key, value in fields.items()):
+            return order
+    return None
+
+def find_order_by_checkout_request(checkout_request_id: str) -> Optional[Dict[str, Any]]:
+    """Find the order that any of its STK pushes' CheckoutRequestIDs belongs to"""
+    for order in _read_orders():
+        if (checkout_request_id in (order.get('checkout_request_ids') or [])
+                or order.get('checkout_request_id') == checkout_request_id):
+            return order
+    return None
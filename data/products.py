@@ -4,6 +4,8 @@ from typing import List, Optional
 import json
 import os
 
+from utils.inventory import inventory_manager
+
 @dataclass
 class Product:
     id: str
@@ -16,6 +18,7 @@ class Product:
     sizes: Optional[List[str]] = None
     colors: Optional[List[str]] = None
     images: Optional[List[str]] = None
+    stock: Optional[int] = None
 
 def load_json_products():
     """Load products from JSON file"""
@@ -26,7 +29,7 @@ def load_json_products():
                 return []
             
             data = json.loads(content)
-            return [
+            products = [
                 Product(
                     id=item.get('id', ''),
                     name=item.get('name', ''),
@@ -41,9 +44,19 @@ def load_json_products():
                 )
                 for item in data
             ]
+            return apply_stock_snapshot(products)
     except (FileNotFoundError, json.JSONDecodeError):
         return []
 
+def apply_stock_snapshot(products: List[Product]) -> List[Product]:
+    """Overlay cached stock counts onto products; untracked products are left as-is"""
+    snapshot = inventory_manager.get_snapshot()
+    for product in products:
+        if product.id in snapshot:
+            product.stock = snapshot[product.id]
+            product.in_stock = product.in_stock and product.stock > 0
+    return products
+
 def get_all_products():
     """Get all products - always fresh from JSON"""
     return load_json_products()
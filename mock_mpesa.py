@@ -0,0 +1,164 @@
+"""Local stand-in for the M-Pesa Daraja STK push API.
+
+Accepts STK push requests and, after a short delay, posts a Daraja-shaped
+callback to the request's CallBackURL, so checkout can be exercised and
+load-tested offline. Like Daraja, every push prompts the customer again, and
+results can be polled through the STK push query endpoint. ``--timeout-rate``
+makes some pushes answer only after the client has given up, while the
+prompt still goes out, to exercise retries of pushes with unknown outcomes:
+
+    python mock_mpesa.py --port 5001 --callback-delay 2 --fail-rate 0.1 --timeout-rate 0.2
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+app.config['CALLBACK_DELAY'] = 2.0
+app.config['FAIL_RATE'] = 0.0
+app.config['TIMEOUT_RATE'] = 0.0
+app.config['TIMEOUT_DELAY'] = 15.0
+
+# CheckoutRequestID -> callback, filled in once the customer has answered
+_results = {}
+_results_lock = threading.Lock()
+
+
+def send_callback(url, payload, delay):
+    """Post the payment result to the merchant after the simulated PIN entry"""
+    time.sleep(delay)
+    callback = payload['Body']['stkCallback']
+    with _results_lock:
+        _results[callback['CheckoutRequestID']] = callback
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        urllib.request.urlopen(req, timeout=10).close()
+    except Exception as e:
+        print(f'Error delivering callback to {url}: {e}')
+
+
+def build_callback(response, data, success):
+    callback = {
+        'MerchantRequestID': response['MerchantRequestID'],
+        'CheckoutRequestID': response['CheckoutRequestID'],
+    }
+    if success:
+        callback.update({
+            'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': data.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': uuid.uuid4().hex[:10].upper()},
+                {'Name': 'TransactionDate', 'Value': int(time.strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': data.get('PhoneNumber')},
+            ]},
+        })
+    else:
+        callback.update({
+            'ResultCode': 1032,
+            'ResultDesc': 'Request cancelled by user',
+        })
+    return {'Body': {'stkCallback': callback}}
+
+
+@app.route('/oauth/v1/generate')
+def generate_token():
+    # Any Basic credentials are accepted; only the shape of the flow is mocked
+    if not request.headers.get('Authorization', '').startswith('Basic '):
+        return jsonify({'errorCode': '400.008.01', 'errorMessage': 'Invalid Authentication passed'}), 400
+    return jsonify({'access_token': uuid.uuid4().hex, 'expires_in': '3599'})
+
+
+@app.route('/mpesa/stkpush/v1/processrequest', methods=['POST'])
+def process_request():
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return jsonify({'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'}), 401
+    data = request.get_json() or {}
+    required = ('Password', 'Timestamp', 'PhoneNumber', 'Amount', 'CallBackURL')
+    if not all(data.get(field) for field in required):
+        return jsonify({
+            'errorCode': '400.002.02',
+            'errorMessage': 'Bad Request - Invalid request payload'
+        }), 400
+
+    response = {
+        'MerchantRequestID': uuid.uuid4().hex[:20],
+        'CheckoutRequestID': f'ws_CO_{uuid.uuid4().hex[:20]}',
+        'ResponseCode': '0',
+        'ResponseDescription': 'Success. Request accepted for processing',
+        'CustomerMessage': 'Success. Request accepted for processing',
+    }
+    with _results_lock:
+        _results[response['CheckoutRequestID']] = None
+
+    success = random.random() >= app.config['FAIL_RATE']
+    threading.Thread(
+        target=send_callback,
+        args=(data['CallBackURL'], build_callback(response, data, success), app.config['CALLBACK_DELAY']),
+        daemon=True
+    ).start()
+
+    if random.random() < app.config['TIMEOUT_RATE']:
+        # The prompt is already on its way; only the response is late
+        time.sleep(app.config['TIMEOUT_DELAY'])
+    return jsonify(response)
+
+
+@app.route('/mpesa/stkpushquery/v1/query', methods=['POST'])
+def query_request():
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return jsonify({'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'}), 401
+    data = request.get_json() or {}
+    checkout_request_id = data.get('CheckoutRequestID')
+    with _results_lock:
+        if checkout_request_id not in _results:
+            return jsonify({
+                'errorCode': '400.002.02',
+                'errorMessage': 'Bad Request - Invalid CheckoutRequestID'
+            }), 400
+        callback = _results[checkout_request_id]
+
+    if callback is None:
+        return jsonify({
+            'errorCode': '500.001.1001',
+            'errorMessage': 'The transaction is being processed'
+        }), 500
+    return jsonify({
+        'ResponseCode': '0',
+        'ResponseDescription': 'The service request has been accepted successfully',
+        'MerchantRequestID': callback['MerchantRequestID'],
+        'CheckoutRequestID': callback['CheckoutRequestID'],
+        'ResultCode': str(callback['ResultCode']),
+        'ResultDesc': callback['ResultDesc'],
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local mock M-Pesa STK push server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--callback-delay', type=float, default=2.0,
+                        help='seconds before the payment callback is sent')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='fraction of payments reported as cancelled')
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+                        help='fraction of pushes whose response is held back past the client timeout')
+    parser.add_argument('--timeout-delay', type=float, default=15.0,
+                        help='seconds a held-back push response is delayed')
+    args = parser.parse_args()
+    app.config['CALLBACK_DELAY'] = args.callback_delay
+    app.config['FAIL_RATE'] = args.fail_rate
+    app.config['TIMEOUT_RATE'] = args.timeout_rate
+    app.config['TIMEOUT_DELAY'] = args.timeout_delay
+    app.run(host=args.host, port=args.port, threaded=True)
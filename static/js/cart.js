@@ -88,7 +88,7 @@ function addToCart(productId) {
             updateCartDisplay(data.cart_count, data.cart_total);
             showNotification('Product added to cart successfully!', 'success');
         } else {
-            showNotification('Failed to add product to cart', 'error');
+            showNotification(data.error || 'Failed to add product to cart', 'error');
         }
     })
     .catch(error => {
@@ -201,9 +201,10 @@ function performSearch(query) {
     }
     
     fetch(`/api/search?q=${encodeURIComponent(query)}`)
-        .then(response => response.json())
+        .then(response => response.ok ? response.json() : null)
         .then(products => {
-            displaySearchResults(products);
+            // Rate-limited or busy: keep the current results until the next keystroke
+            if (products) displaySearchResults(products);
         })
         .catch(error => {
             console.error('Search error:', error);
@@ -298,9 +299,9 @@ if (heroSearchInput) {
 document.addEventListener('DOMContentLoaded', function() {
     // Fetch initial cart state
     fetch('/get_cart_count')
-        .then(response => response.json())
+        .then(response => response.ok ? response.json() : null)
         .then(data => {
-            updateCartDisplay(data.count || 0, data.total || 0);
+            if (data) updateCartDisplay(data.count || 0, data.total || 0);
         })
         .catch(error => {
             console.error('Error fetching cart state:', error);
@@ -0,0 +1,265 @@
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class OutOfStockError(Exception):
+    """Raised when a reservation asks for more units than are available"""
+
+    def __init__(self, product_id: str, requested: int, available: int):
+        self.product_id = product_id
+        self.requested = requested
+        self.available = available
+        super().__init__(
+            f'Only {available} unit(s) of product {product_id} available, {requested} requested'
+        )
+
+
+class InventoryManager:
+    """Quantity-based stock counts backed by a shared SQLite file.
+
+    Stock is counted per product; sizes and colors share one count because
+    cart lines do not record a selection. Products without a stock row are
+    untracked and fall back to their ``in_stock`` flag. Writes run inside short ``BEGIN IMMEDIATE``
+    transactions so concurrent checkouts across gunicorn workers serialize
+    on the database lock; listing pages read a per-process cached snapshot.
+    """
+
+    DB_PATH = 'inventory.db'
+    RESERVATION_TTL = 15 * 60  # seconds a checkout holds its stock
+    MAX_UNITS_PER_LINE = 10  # most units of one product a checkout can hold
+    SNAPSHOT_TTL = 5  # seconds a listing snapshot is reused
+    LOCK_TIMEOUT = 10  # seconds to wait for the write lock
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or self.DB_PATH
+        self._snapshot: Optional[Dict[str, int]] = None
+        self._snapshot_at = 0.0
+        self._snapshot_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection; one per call so forked workers never share handles"""
+        conn = sqlite3.connect(self.db_path, timeout=self.LOCK_TIMEOUT, isolation_level=None)
+        if not self._initialized:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS stock (
+                    product_id TEXT PRIMARY KEY,
+                    quantity INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS reservations (
+                    reservation_id TEXT NOT NULL,
+                    product_id TEXT NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_reservations_product
+                    ON reservations (product_id, expires_at);
+                CREATE INDEX IF NOT EXISTS idx_reservations_id
+                    ON reservations (reservation_id);
+            """)
+            self._initialized = True
+        return conn
+
+    def _invalidate_snapshot(self) -> None:
+        # Expire rather than drop it, so a failed refresh can still serve it
+        with self._snapshot_lock:
+            self._snapshot_at = 0.0
+
+    def get_snapshot(self) -> Dict[str, int]:
+        """Get available units per tracked product, cached for SNAPSHOT_TTL seconds"""
+        now = time.time()
+        with self._snapshot_lock:
+            if self._snapshot is not None and now - self._snapshot_at < self.SNAPSHOT_TTL:
+                return self._snapshot
+
+        conn = None
+        try:
+            conn = self._connect()
+            rows = conn.execute("""
+                SELECT s.product_id,
+                       s.quantity - COALESCE((
+                           SELECT SUM(r.quantity) FROM reservations r
+                           WHERE r.product_id = s.product_id
+                             AND r.expires_at > ?
+                       ), 0)
+                FROM stock s
+            """, (now,)).fetchall()
+        except sqlite3.Error as e:
+            print('Error reading stock snapshot:', e)
+            with self._snapshot_lock:
+                return self._snapshot or {}
+        finally:
+            if conn is not None:
+                conn.close()
+
+        snapshot = {product_id: max(int(available or 0), 0) for product_id, available in rows}
+        with self._snapshot_lock:
+            self._snapshot = snapshot
+            self._snapshot_at = now
+        return snapshot
+
+    def get_stock(self, product_id: str) -> Optional[int]:
+        """Get the on-hand count for a product, or None if it is untracked"""
+        conn = None
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT quantity FROM stock WHERE product_id = ?', (product_id,)
+            ).fetchone()
+        finally:
+            if conn is not None:
+                conn.close()
+        return row[0] if row else None
+
+    def set_stock(self, product_id: str, quantity: Optional[int]) -> None:
+        """Set the on-hand count for a product; None stops tracking it"""
+        conn = None
+        try:
+            conn = self._connect()
+            if quantity is None:
+                conn.execute('DELETE FROM stock WHERE product_id = ?', (product_id,))
+            else:
+                conn.execute("""
+                    INSERT INTO stock (product_id, quantity) VALUES (?, ?)
+                    ON CONFLICT (product_id) DO UPDATE SET quantity = excluded.quantity
+                """, (product_id, max(int(quantity), 0)))
+        finally:
+            if conn is not None:
+                conn.close()
+        self._invalidate_snapshot()
+
+    def delete_product(self, product_id: str) -> None:
+        """Forget all stock and reservations for a product"""
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM stock WHERE product_id = ?', (product_id,))
+            conn.execute('DELETE FROM reservations WHERE product_id = ?', (product_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+        self._invalidate_snapshot()
+
+    def reserve(self, items: Iterable[Tuple[str, int]],
+                reservation_id: Optional[str] = None) -> str:
+        """Hold stock for (product_id, quantity) pairs and return the reservation id.
+
+        Passing an existing reservation_id replaces its lines atomically, so a
+        checkout can update its hold after the cart changes. The hold keeps its
+        original expiry until it lapses, so revisiting checkout cannot hold
+        stock indefinitely. Raises OutOfStockError if any tracked product cannot
+        be covered or a line asks for more than MAX_UNITS_PER_LINE.
+        """
+        reservation_id = reservation_id or uuid.uuid4().hex
+        now = time.time()
+
+        requested: Dict[str, int] = {}
+        for product_id, quantity in items:
+            requested[product_id] = requested.get(product_id, 0) + int(quantity)
+
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM reservations WHERE expires_at <= ?', (now,))
+            expires_at = conn.execute(
+                'SELECT MIN(expires_at) FROM reservations WHERE reservation_id = ?',
+                (reservation_id,)
+            ).fetchone()[0] or now + self.RESERVATION_TTL
+            conn.execute('DELETE FROM reservations WHERE reservation_id = ?', (reservation_id,))
+
+            for product_id, quantity in requested.items():
+                row = conn.execute(
+                    'SELECT quantity FROM stock WHERE product_id = ?', (product_id,)
+                ).fetchone()
+                if row is None:
+                    continue  # untracked product
+
+                held = conn.execute(
+                    'SELECT COALESCE(SUM(quantity), 0) FROM reservations WHERE product_id = ?',
+                    (product_id,)
+                ).fetchone()[0]
+                available = min(row[0] - held, self.MAX_UNITS_PER_LINE)
+                if quantity > available:
+                    raise OutOfStockError(product_id, quantity, max(available, 0))
+
+                conn.execute(
+                    'INSERT INTO reservations (reservation_id, product_id, quantity, expires_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    (reservation_id, product_id, quantity, expires_at)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+
+        self._invalidate_snapshot()
+        return reservation_id
+
+    def commit(self, reservation_id: str) -> None:
+        """Turn a reservation into a permanent stock decrement"""
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("""
+                UPDATE stock SET quantity = MAX(quantity - (
+                    SELECT SUM(r.quantity) FROM reservations r
+                    WHERE r.reservation_id = ?
+                      AND r.product_id = stock.product_id
+                ), 0)
+                WHERE EXISTS (
+                    SELECT 1 FROM reservations r
+                    WHERE r.reservation_id = ?
+                      AND r.product_id = stock.product_id
+                )
+            """, (reservation_id, reservation_id))
+            conn.execute('DELETE FROM reservations WHERE reservation_id = ?', (reservation_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+        self._invalidate_snapshot()
+
+    def restock(self, items: Iterable[Tuple[str, int]]) -> None:
+        """Add (product_id, quantity) pairs back to tracked products"""
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            for product_id, quantity in items:
+                conn.execute(
+                    'UPDATE stock SET quantity = quantity + ? WHERE product_id = ?',
+                    (int(quantity), product_id)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+        self._invalidate_snapshot()
+
+
+# Shared instance used by the product loaders and the checkout routes
+inventory_manager = InventoryManager()
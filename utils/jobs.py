@@ -0,0 +1,176 @@
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    attempts: int
+    max_attempts: int
+
+
+class JobQueue:
+    """Durable job queue backed by a shared SQLite file.
+
+    Jobs are claimed under a lease, so a job held by a crashed worker is
+    picked up again once its lease runs out. Failed jobs are retried with
+    exponential backoff until ``max_attempts`` is reached. An idempotency
+    key makes enqueueing the same logical job twice a no-op.
+    """
+
+    DB_PATH = 'jobs.db'
+    MAX_ATTEMPTS = 5
+    BACKOFF_BASE = 2  # seconds before the first retry, doubled each attempt
+    BACKOFF_MAX = 5 * 60
+    LEASE_SECONDS = 60  # how long a claimed job is reserved for one worker
+    LOCK_TIMEOUT = 10
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or self.DB_PATH
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection; one per call so forked workers never share handles"""
+        conn = sqlite3.connect(self.db_path, timeout=self.LOCK_TIMEOUT, isolation_level=None)
+        if not self._initialized:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    idempotency_key TEXT UNIQUE,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    run_at REAL NOT NULL,
+                    locked_until REAL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (status, run_at);
+            """)
+            self._initialized = True
+        return conn
+
+    def enqueue(self, kind: str, payload: Dict[str, Any],
+                idempotency_key: Optional[str] = None,
+                max_attempts: Optional[int] = None, delay: float = 0) -> bool:
+        """Add a job; returns False if a job with the same idempotency key exists"""
+        now = time.time()
+        conn = None
+        try:
+            conn = self._connect()
+            cursor = conn.execute("""
+                INSERT OR IGNORE INTO jobs
+                    (kind, payload, idempotency_key, max_attempts, run_at, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (kind, json.dumps(payload), idempotency_key,
+                  max_attempts or self.MAX_ATTEMPTS, now + delay, now))
+            return cursor.rowcount == 1
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def claim(self) -> Optional[Job]:
+        """Take the next due job, or None if nothing is ready"""
+        now = time.time()
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("""
+                SELECT id, kind, payload, attempts, max_attempts FROM jobs
+                WHERE (status = 'pending' AND run_at <= ?)
+                   OR (status = 'running' AND locked_until <= ?)
+                ORDER BY run_at
+                LIMIT 1
+            """, (now, now)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute("""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?
+                WHERE id = ?
+            """, (now + self.LEASE_SECONDS, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+
+        job_id, kind, payload, attempts, max_attempts = row
+        return Job(id=job_id, kind=kind, payload=json.loads(payload),
+                   attempts=attempts + 1, max_attempts=max_attempts)
+
+    def complete(self, job: Job) -> None:
+        """Mark a job as done"""
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute("""
+                UPDATE jobs SET status = 'done', locked_until = NULL, finished_at = ?
+                WHERE id = ?
+            """, (time.time(), job.id))
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def fail(self, job: Job, error: str) -> None:
+        """Schedule a retry with backoff, or give up after max_attempts"""
+        now = time.time()
+        conn = None
+        try:
+            conn = self._connect()
+            if job.attempts >= job.max_attempts:
+                conn.execute("""
+                    UPDATE jobs SET status = 'failed', locked_until = NULL,
+                                    last_error = ?, finished_at = ?
+                    WHERE id = ?
+                """, (error, now, job.id))
+            else:
+                delay = min(self.BACKOFF_BASE * 2 ** (job.attempts - 1), self.BACKOFF_MAX)
+                conn.execute("""
+                    UPDATE jobs SET status = 'pending', locked_until = NULL,
+                                    last_error = ?, run_at = ?
+                    WHERE id = ?
+                """, (error, now + delay, job.id))
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def get_counts(self) -> Dict[str, int]:
+        """Get the number of jobs per status"""
+        conn = None
+        try:
+            conn = self._connect()
+            rows = conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        finally:
+            if conn is not None:
+                conn.close()
+        return {status: count for status, count in rows}
+
+
+# Shared instance used by the web app and the worker
+job_queue = JobQueue()
+
+
+def enqueue_order_jobs(order: Dict[str, Any]) -> None:
+    """Queue the follow-up jobs for a saved order; safe to call more than once"""
+    order_id = order['id']
+    if order.get('mpesa_phone'):
+        job_queue.enqueue('mpesa_stk_push', {'order_id': order_id},
+                          idempotency_key=f'mpesa_stk_push:{order_id}')
+    job_queue.enqueue('order_confirmation', {'order_id': order_id},
+                      idempotency_key=f'order_confirmation:{order_id}')
+    job_queue.enqueue('admin_notification', {'order_id': order_id},
+                      idempotency_key=f'admin_notification:{order_id}')
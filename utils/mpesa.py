@@ -0,0 +1,193 @@
+import base64
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+# Defaults target mock_mpesa.py. For Safaricom Daraja, set MPESA_API_URL to
+# https://sandbox.safaricom.co.ke (or https://api.safaricom.co.ke) and supply
+# the app's consumer key/secret and the shortcode's Lipa na M-Pesa passkey.
+MPESA_API_URL = os.environ.get('MPESA_API_URL', 'http://127.0.0.1:5001')
+MPESA_CALLBACK_URL = os.environ.get('MPESA_CALLBACK_URL', 'http://127.0.0.1:5000/mpesa/callback')
+MPESA_SHORTCODE = os.environ.get('MPESA_SHORTCODE', '174379')
+MPESA_CONSUMER_KEY = os.environ.get('MPESA_CONSUMER_KEY', 'mock-key')
+MPESA_CONSUMER_SECRET = os.environ.get('MPESA_CONSUMER_SECRET', 'mock-secret')
+MPESA_PASSKEY = os.environ.get('MPESA_PASSKEY', 'mock-passkey')
+REQUEST_TIMEOUT = 10
+
+# Daraja timestamps are in East Africa Time
+EAT = timezone(timedelta(hours=3))
+
+_token = {'value': None, 'expires_at': 0.0}
+_token_lock = threading.Lock()
+
+
+# Daraja's STK query error while the customer has not answered the prompt yet
+STILL_PROCESSING = '500.001.1001'
+
+
+class MpesaError(Exception):
+    """Raised when an M-Pesa request fails; it may or may not have been acted on"""
+
+    def __init__(self, message: str, code: Optional[str] = None):
+        super().__init__(message)
+        self.code = code
+
+
+class MpesaRejected(MpesaError):
+    """Raised when M-Pesa refused a request or never received it, so nothing was started"""
+
+
+def to_msisdn(phone: str) -> str:
+    """Convert a normalized 07XXXXXXXX number to 2547XXXXXXXX"""
+    return '254' + phone[1:] if phone.startswith('0') else phone
+
+
+def _request_json(req: urllib.request.Request, action: str) -> Dict[str, Any]:
+    """Send a request, separating definite rejections from unknown outcomes"""
+    try:
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as resp:
+            return json.loads(resp.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        try:
+            body = json.loads(e.read().decode('utf-8'))
+        except ValueError:
+            body = {}
+        message = body.get('errorMessage') or str(e)
+        error = MpesaRejected if e.code < 500 else MpesaError
+        raise error(f'{action} request failed: {message}', body.get('errorCode')) from e
+    except urllib.error.URLError as e:
+        if isinstance(e.reason, ConnectionRefusedError):
+            raise MpesaRejected(f'{action} request failed: {e.reason}') from e
+        raise MpesaError(f'{action} request failed: {e.reason}') from e
+    except Exception as e:
+        # Timeouts land here: the request may have been accepted
+        raise MpesaError(f'{action} request failed: {e}') from e
+
+
+def get_access_token() -> str:
+    """Get an OAuth bearer token, reusing it until shortly before it expires"""
+    with _token_lock:
+        if _token['value'] and time.time() < _token['expires_at']:
+            return _token['value']
+
+        credentials = base64.b64encode(
+            f'{MPESA_CONSUMER_KEY}:{MPESA_CONSUMER_SECRET}'.encode('utf-8')
+        ).decode('ascii')
+        req = urllib.request.Request(
+            f'{MPESA_API_URL}/oauth/v1/generate?grant_type=client_credentials',
+            headers={'Authorization': f'Basic {credentials}'}
+        )
+        data = _request_json(req, 'OAuth')
+        if not data.get('access_token'):
+            raise MpesaError('OAuth response had no access token')
+
+        _token['value'] = data['access_token']
+        _token['expires_at'] = time.time() + int(data.get('expires_in', 3599)) - 60
+        return _token['value']
+
+
+def stk_password(timestamp: str) -> str:
+    """Build the STK push Password: base64(shortcode + passkey + timestamp)"""
+    return base64.b64encode(
+        f'{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}'.encode('utf-8')
+    ).decode('ascii')
+
+
+def stk_push(phone: str, amount: float, reference: str) -> Dict[str, Any]:
+    """Send an STK push prompt to the customer's phone.
+
+    Returns the API response, which carries the CheckoutRequestID that the
+    later callback refers to. Raises MpesaRejected if no prompt was sent, or
+    MpesaError if the outcome is unknown (e.g. the response timed out). Daraja
+    does not deduplicate pushes, so only retry after MpesaRejected.
+    """
+    try:
+        token = get_access_token()
+    except MpesaError as e:
+        # No push was sent without a token
+        raise MpesaRejected(str(e), e.code) from e
+
+    timestamp = datetime.now(EAT).strftime('%Y%m%d%H%M%S')
+    body = json.dumps({
+        'BusinessShortCode': MPESA_SHORTCODE,
+        'Password': stk_password(timestamp),
+        'Timestamp': timestamp,
+        'TransactionType': 'CustomerPayBillOnline',
+        'Amount': int(round(amount)),
+        'PartyA': to_msisdn(phone),
+        'PartyB': MPESA_SHORTCODE,
+        'PhoneNumber': to_msisdn(phone),
+        'CallBackURL': MPESA_CALLBACK_URL,
+        'AccountReference': reference,
+        'TransactionDesc': f'Order {reference}',
+    }).encode('utf-8')
+    req = urllib.request.Request(
+        f'{MPESA_API_URL}/mpesa/stkpush/v1/processrequest',
+        data=body,
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {token}',
+        },
+        method='POST'
+    )
+    try:
+        data = _request_json(req, 'STK push')
+    except MpesaError:
+        # A rejected or revoked token should not be reused on the retry
+        _token['value'] = None
+        raise
+
+    if str(data.get('ResponseCode')) != '0':
+        raise MpesaRejected(data.get('ResponseDescription') or 'STK push rejected')
+    return data
+
+
+def stk_query(checkout_request_id: str) -> Optional[Dict[str, Any]]:
+    """Ask M-Pesa for the result of an earlier STK push.
+
+    Returns the response (ResultCode 0 means paid) or None while the
+    customer has not answered the prompt yet.
+    """
+    timestamp = datetime.now(EAT).strftime('%Y%m%d%H%M%S')
+    body = json.dumps({
+        'BusinessShortCode': MPESA_SHORTCODE,
+        'Password': stk_password(timestamp),
+        'Timestamp': timestamp,
+        'CheckoutRequestID': checkout_request_id,
+    }).encode('utf-8')
+    req = urllib.request.Request(
+        f'{MPESA_API_URL}/mpesa/stkpushquery/v1/query',
+        data=body,
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {get_access_token()}',
+        },
+        method='POST'
+    )
+    try:
+        return _request_json(req, 'STK query')
+    except MpesaError as e:
+        if e.code == STILL_PROCESSING:
+            return None
+        _token['value'] = None
+        raise
+
+
+def parse_callback(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten a Daraja STK callback body into the fields we store on an order"""
+    callback = (data.get('Body') or {}).get('stkCallback') or {}
+    items = (callback.get('CallbackMetadata') or {}).get('Item') or []
+    metadata = {item.get('Name'): item.get('Value') for item in items}
+    return {
+        'checkout_request_id': callback.get('CheckoutRequestID'),
+        'result_code': callback.get('ResultCode'),
+        'result_desc': callback.get('ResultDesc'),
+        'receipt': metadata.get('MpesaReceiptNumber'),
+        'amount': metadata.get('Amount'),
+        'phone': metadata.get('PhoneNumber'),
+    }
@@ -0,0 +1,295 @@
+import cProfile
+import hashlib
+import hmac
+import json
+import math
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+
+from flask import g, request, session, template_rendered, before_render_template
+
+
+class StackSampler:
+    """Sample one thread's Python stack at a fixed interval into collapsed stacks"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        """Render samples in the folded format read by flamegraph.pl and speedscope"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class RequestProfiler:
+    """Opt-in per-request profiling.
+
+    A request is profiled when it carries ``X-Profile-Token`` or ``?profile=``
+    matching ``app.config['PROFILE_TOKEN']``, or when it is picked by the
+    ``PROFILE_SAMPLE_RATE`` lottery. Each profiled request writes a collapsed
+    stack file, a cProfile dump and a JSON summary (including template render
+    and file I/O time) to ``PROFILE_DIR``. The sample rate can be changed from
+    /admin/profiles, which also requires the token; workers pick it up without
+    a restart.
+    """
+
+    PROFILE_DIR = 'profiles'
+    SAMPLE_INTERVAL = 0.002  # seconds between stack samples
+    SETTINGS_TTL = 5  # seconds a worker reuses the saved sample rate
+    MAX_PROFILES = 200  # oldest profiles are pruned beyond this
+    TOP_FUNCTIONS = 25
+
+    def __init__(self, app=None):
+        self._settings: Dict[str, Any] = {}
+        self._settings_at = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        self.app = app
+        app.config.setdefault('PROFILE_TOKEN', os.environ.get('PROFILE_TOKEN'))
+        app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+        app.config.setdefault('PROFILE_DIR', self.PROFILE_DIR)
+        app.before_request(self._start)
+        app.after_request(self._record_status)
+        app.teardown_request(self._finish)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+
+    # Settings shared across workers through a small JSON file
+
+    def _settings_path(self) -> str:
+        return os.path.join(self.app.config['PROFILE_DIR'], 'settings.json')
+
+    def get_sample_rate(self) -> float:
+        """Get the sample rate, preferring the value saved from /admin/profiles"""
+        now = time.time()
+        if now - self._settings_at >= self.SETTINGS_TTL:
+            try:
+                with open(self._settings_path(), 'r') as f:
+                    self._settings = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._settings = {}
+            self._settings_at = now
+        return float(self._settings.get('sample_rate', self.app.config['PROFILE_SAMPLE_RATE']))
+
+    def set_sample_rate(self, rate: float) -> None:
+        """Save a new sample rate for all workers; raises ValueError if it is not a number"""
+        rate = float(rate)
+        if not math.isfinite(rate):
+            raise ValueError(f'Invalid sample rate: {rate}')
+        rate = min(max(rate, 0.0), 1.0)
+        os.makedirs(self.app.config['PROFILE_DIR'], exist_ok=True)
+        with open(self._settings_path(), 'w') as f:
+            json.dump({'sample_rate': rate}, f)
+        self._settings = {'sample_rate': rate}
+        self._settings_at = time.time()
+
+    # Request hooks
+
+    def _trigger(self) -> Optional[str]:
+        if request.endpoint == 'static':
+            return None
+        if token_matches(self.app.config.get('PROFILE_TOKEN')):
+            return 'on-demand'
+        rate = self.get_sample_rate()
+        if rate > 0 and random.random() < rate:
+            return 'sampled'
+        return None
+
+    def _start(self) -> None:
+        trigger = self._trigger()
+        if trigger is None:
+            return
+        g.profile = {
+            'trigger': trigger,
+            'template_time': 0.0,
+            'template_started': [],
+            'status': None,
+            'started': time.perf_counter(),
+        }
+        g.profile['sampler'] = StackSampler(threading.get_ident(), self.SAMPLE_INTERVAL)
+        g.profile['profiler'] = cProfile.Profile()
+        g.profile['sampler'].start()
+        g.profile['profiler'].enable()
+
+    def _record_status(self, response):
+        if 'profile' in g:
+            g.profile['status'] = response.status_code
+        return response
+
+    def _template_started(self, sender, template, context, **extra) -> None:
+        if 'profile' in g:
+            g.profile['template_started'].append(time.perf_counter())
+
+    def _template_finished(self, sender, template, context, **extra) -> None:
+        if 'profile' in g and g.profile['template_started']:
+            g.profile['template_time'] += time.perf_counter() - g.profile['template_started'].pop()
+
+    def _finish(self, exc) -> None:
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile['profiler'].disable()
+        profile['sampler'].stop()
+        duration = time.perf_counter() - profile['started']
+        try:
+            self._save(profile, duration, exc)
+        except Exception as e:
+            print('Error saving request profile:', e)
+
+    # Output
+
+    def _save(self, profile: Dict[str, Any], duration: float, exc) -> None:
+        profile_dir = self.app.config['PROFILE_DIR']
+        os.makedirs(profile_dir, exist_ok=True)
+
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root'
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}_{request.method}_{slug[:60]}"
+        base = os.path.join(profile_dir, name)
+
+        stats = pstats.Stats(profile['profiler'])
+        stats.dump_stats(f'{base}.prof')
+        with open(f'{base}.folded', 'w') as f:
+            f.write(profile['sampler'].collapsed())
+
+        summary = {
+            'name': name,
+            'method': request.method,
+            'path': request_path(),
+            'endpoint': request.endpoint,
+            'status': 500 if exc is not None else profile['status'],
+            'trigger': profile['trigger'],
+            'pid': os.getpid(),
+            'created_at': datetime.now().isoformat(),
+            'duration_ms': round(duration * 1000, 2),
+            'template_ms': round(profile['template_time'] * 1000, 2),
+            'io_ms': round(file_io_time(stats) * 1000, 2),
+            'samples': sum(profile['sampler'].stacks.values()),
+            'top_functions': top_functions(stats, self.TOP_FUNCTIONS),
+        }
+        with open(f'{base}.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        self._prune(profile_dir)
+
+    def _prune(self, profile_dir: str) -> None:
+        summaries = sorted(n for n in os.listdir(profile_dir) if n.endswith('.json') and n != 'settings.json')
+        for old in summaries[:-self.MAX_PROFILES]:
+            for ext in ('.json', '.prof', '.folded'):
+                try:
+                    os.remove(os.path.join(profile_dir, old[:-5] + ext))
+                except FileNotFoundError:
+                    pass
+
+    # Admin access
+
+    def admin_authorized(self) -> bool:
+        """Whether the request may view profiles and change the sample rate.
+
+        The token is accepted once from the header or ``?profile=`` and then
+        remembered in the session. The session only holds a digest of the
+        token, so a forged cookie cannot unlock the pages, and changing the
+        token revokes access.
+        """
+        token = self.app.config.get('PROFILE_TOKEN')
+        if not token:
+            return False
+        digest = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        if token_matches(token):
+            session['profile_token'] = digest
+            return True
+        return hmac.compare_digest(str(session.get('profile_token', '')), digest)
+
+    def list_profiles(self) -> List[Dict[str, Any]]:
+        """Get saved profile summaries, newest first"""
+        profile_dir = self.app.config['PROFILE_DIR']
+        if not os.path.isdir(profile_dir):
+            return []
+        profiles = []
+        for filename in sorted(os.listdir(profile_dir), reverse=True):
+            if not filename.endswith('.json') or filename == 'settings.json':
+                continue
+            try:
+                with open(os.path.join(profile_dir, filename), 'r') as f:
+                    profiles.append(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                continue
+        return profiles
+
+
+def token_matches(token: Optional[str]) -> bool:
+    """Whether the request carries the profiling token, compared in constant time"""
+    if not token:
+        return False
+    expected = token.encode('utf-8')
+    for supplied in (request.headers.get('X-Profile-Token'), request.args.get('profile')):
+        if supplied and hmac.compare_digest(supplied.encode('utf-8'), expected):
+            return True
+    return False
+
+
+def request_path() -> str:
+    """The request path and query, minus the profiling token"""
+    args = [(key, value) for key, value in request.args.items(multi=True) if key != 'profile']
+    return f'{request.path}?{urlencode(args)}' if args else request.path
+
+
+def _is_file_io(func) -> bool:
+    """Whether a pstats entry is a builtin that touches the filesystem"""
+    filename, _, name = func
+    return filename == '~' and ('_io.' in name or 'io.open' in name or 'posix.' in name)
+
+
+def file_io_time(stats: pstats.Stats) -> float:
+    """Sum the own time of file and OS calls recorded by cProfile"""
+    return sum(tottime for func, (_, _, tottime, _, _) in stats.stats.items() if _is_file_io(func))
+
+
+def top_functions(stats: pstats.Stats, limit: int) -> List[Dict[str, Any]]:
+    """Get the functions with the highest cumulative time"""
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [
+        {
+            'function': pstats.func_std_string(func),
+            'calls': calls,
+            'tottime_ms': round(tottime * 1000, 3),
+            'cumtime_ms': round(cumtime * 1000, 3),
+        }
+        for func, (_, calls, tottime, cumtime, _) in rows
+    ]
+
+
+# Shared instance; attached to the app in app.py
+request_profiler = RequestProfiler()
@@ -0,0 +1,209 @@
+import math
+import random
+import sqlite3
+import time
+import uuid
+from functools import wraps
+from typing import Dict, Optional, Tuple
+
+from flask import current_app, jsonify, request
+
+
+class RateLimiter:
+    """Per-client token buckets and global concurrency caps shared across workers.
+
+    State lives in a small SQLite file so every gunicorn worker sees the same
+    buckets and slots. Limits are read from ``app.config['RATE_LIMITS']``
+    (name -> (tokens per second, burst)) and ``app.config['CONCURRENCY_LIMITS']``
+    (name -> max in-flight requests) when set, otherwise from the defaults below.
+    If the store is unavailable the request is let through rather than failed.
+
+    Clients are keyed by ``request.remote_addr``. Behind a reverse proxy, set
+    ``TRUSTED_PROXIES`` (see app.py) so ProxyFix restores the shopper's address
+    from X-Forwarded-For; otherwise every shopper shares the proxy's buckets.
+    """
+
+    DB_PATH = 'ratelimit.db'
+    RATE_LIMITS: Dict[str, Tuple[float, int]] = {
+        'search': (5.0, 20),  # called on every keystroke
+        'cart': (2.0, 20),  # cart updates, cart count and checkout
+    }
+    CONCURRENCY_LIMITS: Dict[str, int] = {
+        'search': 4,  # each search reads and scans products.json
+    }
+    SLOT_LEASE = 30  # seconds before a slot held by a dead worker is reclaimed
+    BUCKET_IDLE = 60 * 60  # seconds before an idle client's bucket is dropped
+    LOCK_TIMEOUT = 0.5  # keep waits short; failing open beats queueing
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or self.DB_PATH
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection; one per call so forked workers never share handles"""
+        conn = sqlite3.connect(self.db_path, timeout=self.LOCK_TIMEOUT, isolation_level=None)
+        if not self._initialized:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS slots (
+                    slot_id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_slots_name ON slots (name, expires_at);
+            """)
+            self._initialized = True
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _client_id(self) -> str:
+        return request.remote_addr or 'unknown'
+
+    def consume(self, name: str, client: str) -> float:
+        """Take one token from the client's bucket.
+
+        Returns 0 if the request is allowed, otherwise the seconds until a
+        token will be available.
+        """
+        limits = current_app.config.get('RATE_LIMITS', self.RATE_LIMITS)
+        if name not in limits:
+            return 0
+        rate, burst = limits[name]
+        key = f'{name}:{client}'
+        now = time.time()
+
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)
+            ).fetchone()
+            tokens = float(burst) if row is None else min(burst, row[0] + (now - row[1]) * rate)
+
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+
+            conn.execute("""
+                INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens,
+                                                updated_at = excluded.updated_at
+            """, (key, tokens, now))
+            # Occasionally drop buckets of clients that went away
+            if random.random() < 0.01:
+                conn.execute('DELETE FROM buckets WHERE updated_at < ?', (now - self.BUCKET_IDLE,))
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            print('Rate limit store unavailable:', e)
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            return 0
+        finally:
+            if conn is not None:
+                conn.close()
+        return retry_after
+
+    def acquire_slot(self, name: str) -> Optional[str]:
+        """Claim one of the in-flight slots for a route.
+
+        Returns a slot id to release later, '' if the route is uncapped or the
+        store is unavailable, or None if all slots are taken.
+        """
+        limits = current_app.config.get('CONCURRENCY_LIMITS', self.CONCURRENCY_LIMITS)
+        if name not in limits:
+            return ''
+        now = time.time()
+        slot_id = uuid.uuid4().hex
+
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM slots WHERE name = ? AND expires_at <= ?', (name, now))
+            in_flight = conn.execute(
+                'SELECT COUNT(*) FROM slots WHERE name = ?', (name,)
+            ).fetchone()[0]
+            if in_flight >= limits[name]:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                'INSERT INTO slots (slot_id, name, expires_at) VALUES (?, ?, ?)',
+                (slot_id, name, now + self.SLOT_LEASE)
+            )
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            print('Rate limit store unavailable:', e)
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            return ''
+        finally:
+            if conn is not None:
+                conn.close()
+        return slot_id
+
+    def release_slot(self, slot_id: str) -> None:
+        """Give back an in-flight slot"""
+        if not slot_id:
+            return
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute('DELETE FROM slots WHERE slot_id = ?', (slot_id,))
+        except sqlite3.Error as e:
+            print('Rate limit store unavailable:', e)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def limit(self, name: str):
+        """Decorator: answer 429 with Retry-After once a client's bucket is empty"""
+        def decorator(view):
+            @wraps(view)
+            def wrapped(*args, **kwargs):
+                retry_after = self.consume(name, self._client_id())
+                if retry_after:
+                    return too_many_requests(retry_after)
+                return view(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    def cap(self, name: str):
+        """Decorator: answer 503 with Retry-After while a route is at its concurrency cap"""
+        def decorator(view):
+            @wraps(view)
+            def wrapped(*args, **kwargs):
+                slot_id = self.acquire_slot(name)
+                if slot_id is None:
+                    return server_busy()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.release_slot(slot_id)
+            return wrapped
+        return decorator
+
+
+def too_many_requests(retry_after: float):
+    response = jsonify({'success': False, 'error': 'Too many requests'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def server_busy():
+    response = jsonify({'success': False, 'error': 'Server busy, please retry'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+# Shared instance used by the route decorators in app.py
+rate_limiter = RateLimiter()
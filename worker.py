@@ -0,0 +1,204 @@
+"""Background worker for post-order jobs.
+
+Run alongside the web app:
+
+    python worker.py            # poll forever
+    python worker.py --burst    # drain due jobs and exit
+"""
+import argparse
+import signal
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from data.orders import (get_order, update_order, load_orders,
+                         add_checkout_request, find_order_by_checkout_request)
+from utils.jobs import job_queue, enqueue_order_jobs
+from utils.mpesa import MpesaRejected, stk_push, stk_query, to_msisdn
+
+POLL_INTERVAL = 1  # seconds to sleep when the queue is empty
+SWEEP_INTERVAL = 30  # seconds between scans for orders whose jobs were never queued
+SWEEP_WINDOW = timedelta(days=1)  # how far back the scan looks
+SETTLED_STATUSES = ('paid', 'failed')
+
+
+def handle_mpesa_stk_push(payload):
+    """Prompt the customer's phone for payment.
+
+    Daraja does not deduplicate pushes, so a push is only sent again when the
+    last one was definitely refused. After a push whose outcome is unknown
+    (e.g. the response timed out) retries ask M-Pesa for the result instead.
+    """
+    order = get_order(payload['order_id'])
+    if not order:
+        raise RuntimeError(f"Order {payload['order_id']} not found")
+    if order.get('payment_status') in SETTLED_STATUSES:
+        return
+    if order.get('stk_push_attempted_at'):
+        check_stk_push(order)
+        return
+
+    update_order(order['id'],
+                 payment_status='prompting',
+                 stk_push_attempted_at=datetime.now().isoformat())
+    try:
+        response = stk_push(order['mpesa_phone'], order['total'], order['id'])
+    except MpesaRejected:
+        # Nothing reached the customer, so the retry may push again
+        update_order(order['id'], payment_status='awaiting_prompt', stk_push_attempted_at=None)
+        raise
+    add_checkout_request(order['id'], response['CheckoutRequestID'])
+
+
+def check_stk_push(order):
+    """Settle an order from the STK push query API after an earlier push attempt"""
+    checkout_request_ids = order.get('checkout_request_ids') or []
+    if not checkout_request_ids:
+        # The push may have reached the phone but its CheckoutRequestID was
+        # lost; leave it to the callback or the shop rather than prompt twice
+        update_order(order['id'], payment_status='unconfirmed')
+        return
+
+    result = None
+    for checkout_request_id in checkout_request_ids:
+        result = stk_query(checkout_request_id)
+        if result is None:
+            # The customer has not answered yet; check again on the next attempt
+            raise RuntimeError(f'STK push {checkout_request_id} is still being processed')
+        if str(result.get('ResultCode')) == '0':
+            update_order(order['id'], payment_status='paid')
+            return
+    update_order(order['id'], payment_status='failed', payment_error=result.get('ResultDesc'))
+
+
+def find_unconfirmed_order(payload):
+    """Match a callback to the one order whose push went out without a stored id"""
+    if payload.get('phone') is None or payload.get('amount') is None:
+        return None
+    matches = [
+        order for order in load_orders()
+        if order.get('payment_status') in ('prompting', 'unconfirmed')
+        and to_msisdn(order.get('mpesa_phone') or '') == str(payload['phone'])
+        and int(round(order.get('total', 0))) == int(payload['amount'])
+    ]
+    return matches[0] if len(matches) == 1 else None
+
+
+def handle_mpesa_callback(payload):
+    """Record the payment result reported by M-Pesa"""
+    checkout_request_id = payload['checkout_request_id']
+    order = find_order_by_checkout_request(checkout_request_id) or find_unconfirmed_order(payload)
+    if not order:
+        # The STK push job may not have stored the request id yet; retry later
+        raise RuntimeError(f'No order for checkout request {checkout_request_id}')
+    order = add_checkout_request(order['id'], checkout_request_id) or order
+
+    if order.get('payment_status') == 'paid':
+        if str(payload.get('result_code')) == '0' and not order.get('mpesa_receipt'):
+            # Settled by an STK query, which carries no receipt number
+            update_order(order['id'], mpesa_receipt=payload.get('receipt'))
+        return
+    if order.get('payment_status') == 'failed':
+        return
+
+    if str(payload.get('result_code')) == '0':
+        update_order(order['id'], payment_status='paid', mpesa_receipt=payload.get('receipt'))
+    else:
+        update_order(order['id'], payment_status='failed', payment_error=payload.get('result_desc'))
+
+
+def handle_order_confirmation(payload):
+    """Send the customer their order confirmation"""
+    order = get_order(payload['order_id'])
+    if not order:
+        raise RuntimeError(f"Order {payload['order_id']} not found")
+    # No email/SMS provider is configured yet, so log what would be sent
+    if order.get('email'):
+        print(f"Order confirmation email to {order['email']}: order {order['id']}, Kshs. {order['total']}")
+    print(f"Order confirmation SMS to {order['phone']}: order {order['id']}, Kshs. {order['total']}")
+
+
+def handle_admin_notification(payload):
+    """Tell the shop about a new order"""
+    order = get_order(payload['order_id'])
+    if not order:
+        raise RuntimeError(f"Order {payload['order_id']} not found")
+    print(f"New order {order['id']} from {order['full_name']} ({order['phone']}): Kshs. {order['total']}")
+
+
+HANDLERS = {
+    'mpesa_stk_push': handle_mpesa_stk_push,
+    'mpesa_callback': handle_mpesa_callback,
+    'order_confirmation': handle_order_confirmation,
+    'admin_notification': handle_admin_notification,
+}
+
+
+def run_job(job):
+    """Run one claimed job and record the outcome"""
+    handler = HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise RuntimeError(f'Unknown job kind: {job.kind}')
+        handler(job.payload)
+    except Exception as e:
+        print(f'Job {job.id} ({job.kind}) failed on attempt {job.attempts}: {e}')
+        traceback.print_exc()
+        job_queue.fail(job, str(e))
+    else:
+        job_queue.complete(job)
+
+
+def sweep_orders():
+    """Queue jobs for recent orders that place_order saved but failed to enqueue.
+
+    Idempotency keys make this a no-op for orders whose jobs already exist.
+    Orders saved before the job queue existed have no payment_status and are
+    left alone, so they never get a payment prompt.
+    """
+    cutoff = datetime.now() - SWEEP_WINDOW
+    for order in load_orders():
+        if 'payment_status' not in order:
+            continue
+        try:
+            created_at = datetime.fromisoformat(order.get('created_at', ''))
+        except (TypeError, ValueError):
+            continue
+        if created_at >= cutoff:
+            enqueue_order_jobs(order)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process queued post-order jobs')
+    parser.add_argument('--burst', action='store_true', help='exit once no jobs are due')
+    args = parser.parse_args()
+
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    last_sweep = 0.0
+    while running:
+        if time.time() - last_sweep >= SWEEP_INTERVAL:
+            try:
+                sweep_orders()
+            except Exception as e:
+                print('Order sweep failed:', e)
+            last_sweep = time.time()
+
+        job = job_queue.claim()
+        if job is None:
+            if args.burst:
+                break
+            time.sleep(POLL_INTERVAL)
+            continue
+        run_job(job)
+
+
+if __name__ == '__main__':
+    main()